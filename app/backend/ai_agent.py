@@ -1,47 +1,102 @@
-from groq import Groq
+from groq import AsyncGroq
 import asyncio
-import json
+import hashlib
+import logging
+import threading
 import time
-from typing import Dict, List, Optional, Tuple
-from datetime import datetime, timedelta
+import zlib
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from datetime import datetime
+import orjson
+from cachetools import TTLCache
+from fastapi import BackgroundTasks
+from sqlalchemy import select, update
+from sqlalchemy.dialects import postgresql, sqlite
 
 from ..core.config import settings
-from ..core.database import get_db, Conversation, UserSession
+from ..core.database import AsyncSessionLocal, Conversation, UserSession, async_engine, new_session_id
+from .batcher import RequestBatcher
 from .models import ChatRequest, ChatResponse
+from .semantic_cache import SemanticCache
+from .token_bucket import AsyncTokenBucket
 
-client = Groq(
+logger = logging.getLogger(__name__)
+
+client = AsyncGroq(
     api_key=settings.GROQ_API_KEY,
+    max_retries=2,
+    timeout=30,
 )
 
+# Dialect-native INSERT ... ON CONFLICT builders for single round-trip upserts; other
+# dialects fall back to UPDATE then INSERT
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+CONTEXT_COMPRESSION_LEVEL = 3  # favours speed; JSON context still shrinks several-fold
+
+
+def pack_context(context: List[Dict]) -> bytes:
+    """Serialize and compress a session context for storage"""
+    return zlib.compress(orjson.dumps(context), CONTEXT_COMPRESSION_LEVEL)
+
+
+def unpack_context(data) -> List[Dict]:
+    """Decode a stored session context, accepting legacy uncompressed JSON rows"""
+    if isinstance(data, str):
+        return orjson.loads(data)
+    try:
+        data = zlib.decompress(data)
+    except zlib.error:
+        pass
+    return orjson.loads(data)
+
 class AIAgent:
+    SYSTEM_PROMPT = "You are a helpful AI assistant integrated with Telegram. Provide clear, concise, and helpful responses."
+    DEFAULT_CONTEXT = [{"role": "system", "content": SYSTEM_PROMPT}]  # shared: contexts are never mutated
+
     def __init__(self):
         self.model = settings.GROQ_AI_MODEL
         self.max_tokens = settings.MAX_TOKENS
-        self.conversation_memory = {}  # In-memory cache for active sessions
+        # In-memory cache for active sessions, bounded and expired after inactivity
+        self.conversation_memory = TTLCache(maxsize=settings.SESSION_CACHE_MAX, ttl=settings.SESSION_TTL_S)
+        self.memory_lock = threading.RLock()
+        self.prompt_cache_stats = {"prompt_tokens": 0, "cached_tokens": 0}
+        self.semantic_cache = SemanticCache() if settings.SEMANTIC_CACHE_ENABLED else None
+        self.persist_semaphore = asyncio.Semaphore(settings.PERSIST_MAX_CONCURRENCY)
+        self.token_bucket = AsyncTokenBucket(settings.MAX_TOKENS_PER_MIN, settings.MAX_REQUESTS_PER_MIN)
+        self.batcher = RequestBatcher(
+            self._complete,
+            max_batch_size=settings.BATCH_SIZE_MAX,
+            batch_timeout=settings.BATCH_TIMEOUT_MS / 1000,
+            max_concurrency=settings.LLM_MAX_CONCURRENCY
+        )  # its semaphore also bounds streamed completions
 
-    async def process_message(self, user_id: int, message: str, session_id: str = None) -> ChatResponse:
-        """Process user message and return AI response"""
+    async def process_message(self, user_id: int, message: str, session_id: str = None,
+                              background_tasks: Optional[BackgroundTasks] = None) -> ChatResponse:
+        """Process user message and return AI response
+
+        When background_tasks is given, the turn is persisted after the response is sent.
+        """
         start_time = time.time()
 
         try:
-            # Get or create session context
+            # Get session context (shared with the cache, never mutated in place)
             context = await self._get_session_context(user_id, session_id)
+            user_turn = {"role": "user", "content": message}
 
-            # Add user message to context
-            context.append({"role": "user", "content": message})
+            # Serve near-duplicate questions from the semantic cache
+            response = await self.semantic_cache.lookup(message, context) if self.semantic_cache else None
+            tokens_used = 0  # cache hits cost no completion tokens
 
             # Generate AI response
-            response = await self._generate_response(context)
-
-            # Add AI response to context
-            context.append({"role": "assistant", "content": response})
+            if response is None:
+                response, tokens_used = await self._generate_response(context + [user_turn])
+                if self.semantic_cache:
+                    await self.semantic_cache.store(message, context, response)
 
-            # Update session context
-            await self._update_session_context(user_id, session_id, context)
-
-            # Log conversation
-            processing_time = int((time.time() - start_time) * 1000)
-            await self._log_conversation(user_id, message, response, processing_time)
+            processing_time = await self._finish_turn(
+                user_id, session_id, context, user_turn, response, tokens_used, start_time, background_tasks
+            )
 
             return ChatResponse(
                 response=response,
@@ -59,122 +114,256 @@ class AIAgent:
                 success=False
             )
 
-    async def _generate_response(self, context: List[Dict]) -> str:
-        """Generate AI response using OpenAI API"""
+    async def stream_message(self, user_id: int, message: str, session_id: str = None,
+                             background_tasks: Optional[BackgroundTasks] = None) -> AsyncIterator[str]:
+        """Process user message and yield the AI response as it is generated"""
+        start_time = time.time()
+
         try:
-            response = client.chat.completions.create(
+            context = await self._get_session_context(user_id, session_id)
+            user_turn = {"role": "user", "content": message}
+
+            response = await self.semantic_cache.lookup(message, context) if self.semantic_cache else None
+            usage = {"total_tokens": 0}
+            if response is not None:
+                yield response
+            else:
+                parts = []
+                async for delta in self._stream_response(context + [user_turn], usage):
+                    parts.append(delta)
+                    yield delta
+                response = "".join(parts).strip()
+                if self.semantic_cache:
+                    await self.semantic_cache.store(message, context, response)
+
+            await self._finish_turn(user_id, session_id, context, user_turn, response, usage["total_tokens"],
+                                    start_time, background_tasks)
+
+        except Exception as e:
+            # Re-raised so the endpoint reports it out of band rather than as response text
+            logger.error("Error streaming message: %s", e)
+            raise
+
+    async def _finish_turn(self, user_id: int, session_id: str, context: List[Dict], user_turn: Dict,
+                           response: str, tokens_used: int, start_time: float,
+                           background_tasks: Optional[BackgroundTasks]) -> int:
+        """Cache the updated context and persist the turn; returns processing time in ms"""
+        # Update session context in memory
+        context = self._append_turns(context, [user_turn, {"role": "assistant", "content": response}])
+        with self.memory_lock:
+            self.conversation_memory[session_id] = context
+
+        # Persist session context and conversation log
+        processing_time = int((time.time() - start_time) * 1000)
+        turn = (user_id, session_id, context, user_turn["content"], response, processing_time, tokens_used)
+        if background_tasks is not None:
+            background_tasks.add_task(self._persist_turn_bounded, *turn)
+        else:
+            await self._persist_turn(*turn)
+        return processing_time
+
+    async def _generate_response(self, context: List[Dict]) -> Tuple[str, int]:
+        """Generate AI response through the request batcher; returns (text, total tokens)"""
+        return await self.batcher.submit(context)
+
+    async def _complete(self, context: List[Dict]) -> Tuple[str, int]:
+        """Generate AI response using OpenAI API; returns (text, total tokens)"""
+        estimated_tokens = self._estimate_tokens(context)
+        await self.token_bucket.acquire(estimated_tokens)
+        try:
+            response = await client.chat.completions.create(
                 model=self.model,
                 messages=context,
                 max_tokens=self.max_tokens,
                 temperature=0.7,
-                timeout=30
+                extra_headers={"prompt-cache-key": self._prompt_cache_key(context)}
             )
-            return response.choices[0].message.content.strip()
+            self._record_prompt_cache_usage(response.usage)
+            total_tokens = response.usage.total_tokens if response.usage else 0
+            if response.usage:
+                self.token_bucket.reconcile(estimated_tokens, total_tokens)
+            return response.choices[0].message.content.strip(), total_tokens
         except Exception as e:
             raise Exception(f"OpenAI API error: {str(e)}")
 
+    async def _stream_response(self, context: List[Dict], usage: Dict) -> AsyncIterator[str]:
+        """Stream AI response deltas from the Groq API
+
+        The completion's total token count, sent with the last chunk, is stored in usage["total_tokens"].
+        """
+        estimated_tokens = self._estimate_tokens(context)
+        async with self.batcher.semaphore:
+            await self.token_bucket.acquire(estimated_tokens)
+            try:
+                stream = await client.chat.completions.create(
+                    model=self.model,
+                    messages=context,
+                    max_tokens=self.max_tokens,
+                    temperature=0.7,
+                    stream=True,
+                    extra_headers={"prompt-cache-key": self._prompt_cache_key(context)}
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+                    chunk_usage = chunk.x_groq.usage if chunk.x_groq else None
+                    if chunk_usage:
+                        self._record_prompt_cache_usage(chunk_usage)
+                        self.token_bucket.reconcile(estimated_tokens, chunk_usage.total_tokens)
+                        usage["total_tokens"] = chunk_usage.total_tokens
+            except Exception as e:
+                raise Exception(f"OpenAI API error: {str(e)}")
+
+    def _estimate_tokens(self, context: List[Dict]) -> int:
+        """Rough token estimate (~4 characters per token) plus the completion budget"""
+        return sum(len(message["content"]) for message in context) // 4 + self.max_tokens
+
+    def _prompt_cache_key(self, context: List[Dict]) -> str:
+        """Hash the stable prefix (system prompt + pinned turns) of the context"""
+        prefix = context[:1 + settings.CONTEXT_PINNED_MESSAGES]
+        return hashlib.sha256(orjson.dumps(prefix, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+    def _record_prompt_cache_usage(self, usage):
+        """Accumulate prompt tokens served from the provider's prefix cache"""
+        if not usage:
+            return
+        details = getattr(usage, "prompt_tokens_details", None)
+        self.prompt_cache_stats["prompt_tokens"] += usage.prompt_tokens or 0
+        self.prompt_cache_stats["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+
     async def _get_session_context(self, user_id: int, session_id: str) -> List[Dict]:
         """Get conversation context for user session"""
-        if session_id in self.conversation_memory:
-            return self.conversation_memory[session_id].copy()
+        with self.memory_lock:
+            context = self.conversation_memory.get(session_id)
+        if context is not None:
+            return context
 
         # Load from database
-        db = next(get_db())
-        try:
-            session = db.query(UserSession).filter(
-                UserSession.user_id == user_id,
-                UserSession.session_id == session_id,
-                UserSession.is_active == True
-            ).first()
-
-            if session and session.context:
-                context = json.loads(session.context)
-                self.conversation_memory[session_id] = context
-                return context.copy()
-        except Exception as e:
-            print(f"Error loading session context: {e}")
-        finally:
-            db.close()
+        async with AsyncSessionLocal() as db:
+            try:
+                result = await db.execute(
+                    select(UserSession).where(
+                        UserSession.user_id == user_id,
+                        UserSession.session_id == session_id,
+                        UserSession.is_active == True
+                    )
+                )
+                session = result.scalars().first()
+
+                if session and session.context:
+                    context = unpack_context(session.context)
+                    with self.memory_lock:
+                        self.conversation_memory[session_id] = context
+                    return context
+            except Exception as e:
+                logger.error("Error loading session context: %s", e)
 
         # Return default system context
-        return [
-            {
-                "role": "system",
-                "content": "You are a helpful AI assistant integrated with Telegram. Provide clear, concise, and helpful responses."
-            }
-        ]
-
-    async def _update_session_context(self, user_id: int, session_id: str, context: List[Dict]):
-        """Update session context in memory and database"""
-        # Keep only last 20 messages to manage memory
-        if len(context) > 20:
-            context = context[:1] + context[-19:]  # Keep system message + last 19
-
-        # Update memory cache
-        self.conversation_memory[session_id] = context
-
-        # Update database
-        db = next(get_db())
-        try:
-            session = db.query(UserSession).filter(
-                UserSession.user_id == user_id,
-                UserSession.session_id == session_id
-            ).first()
-
-            if session:
-                session.context = json.dumps(context)
-                session.updated_at = datetime.utcnow()
-            else:
-                session = UserSession(
+        return self.DEFAULT_CONTEXT
+
+    def _append_turns(self, context: List[Dict], turns: List[Dict]) -> List[Dict]:
+        """Build a new bounded context list from the stored context plus new turns"""
+        # Keep system message + pinned oldest turns fixed so the prompt prefix stays
+        # cacheable, and rotate only the tail window
+        overflow = len(context) + len(turns) - settings.CONTEXT_MAX_MESSAGES
+        if overflow > 0:
+            head = 1 + settings.CONTEXT_PINNED_MESSAGES
+            return context[:head] + context[head + overflow:] + turns
+        return context + turns
+
+    async def _persist_turn_bounded(self, *args):
+        """Persist a turn in the background, capping concurrent database writes"""
+        async with self.persist_semaphore:
+            await self._persist_turn(*args)
+
+    async def _persist_turn(self, user_id: int, session_id: str, context: List[Dict],
+                            message: str, response: str, processing_time: int, tokens_used: int = 0):
+        """Upsert session context and log the conversation in a single transaction"""
+        context_blob = pack_context(context)
+        async with AsyncSessionLocal() as db:
+            try:
+                now = datetime.utcnow()  # same clock as the column defaults used on insert
+                insert = UPSERT_INSERTS.get(async_engine.dialect.name)
+                if insert is not None:
+                    upsert = insert(UserSession).values(
+                        user_id=user_id,
+                        session_id=session_id,
+                        context=context_blob
+                    )
+                    await db.execute(upsert.on_conflict_do_update(
+                        index_elements=[UserSession.session_id],
+                        set_={"context": upsert.excluded.context, "updated_at": now}
+                    ))
+                else:
+                    # No ON CONFLICT on this dialect: update, and insert only for a new session
+                    result = await db.execute(
+                        update(UserSession).where(UserSession.session_id == session_id).values(
+                            context=context_blob, updated_at=now
+                        ).execution_options(synchronize_session=False)
+                    )
+                    if result.rowcount == 0:
+                        db.add(UserSession(user_id=user_id, session_id=session_id, context=context_blob))
+
+                db.add(Conversation(
                     user_id=user_id,
                     session_id=session_id,
-                    context=json.dumps(context)
-                )
-                db.add(session)
+                    message=message,
+                    response=response,
+                    tokens_used=tokens_used,
+                    processing_time=processing_time
+                ))
+                await db.commit()
+            except Exception as e:
+                logger.error("Error persisting conversation turn: %s", e)
+                await db.rollback()
 
-            db.commit()
-        except Exception as e:
-            print(f"Error updating session context: {e}")
-            db.rollback()
-        finally:
-            db.close()
-
-    async def _log_conversation(self, user_id: int, message: str, response: str, processing_time: int):
-        """Log conversation to database"""
-        db = next(get_db())
-        try:
-            conversation = Conversation(
-                user_id=user_id,
-                message=message,
-                response=response,
-                processing_time=processing_time
-            )
-            db.add(conversation)
-            db.commit()
-        except Exception as e:
-            print(f"Error logging conversation: {e}")
-            db.rollback()
-        finally:
-            db.close()
+    async def create_session(self, user_id: int) -> str:
+        """Create a session with the default context and cache it in memory"""
+        session_id = new_session_id(user_id)
+        context = self.DEFAULT_CONTEXT
+
+        with self.memory_lock:
+            self.conversation_memory[session_id] = context
+
+        async with AsyncSessionLocal() as db:
+            try:
+                db.add(UserSession(
+                    user_id=user_id,
+                    session_id=session_id,
+                    context=pack_context(context)
+                ))
+                await db.commit()
+            except Exception as e:
+                logger.error("Error creating session: %s", e)
+                await db.rollback()
+
+        return session_id
 
     async def clear_session(self, user_id: int, session_id: str):
         """Clear user session context"""
-        if session_id in self.conversation_memory:
-            del self.conversation_memory[session_id]
+        with self.memory_lock:
+            self.conversation_memory.pop(session_id, None)
 
-        db = next(get_db())
-        try:
-            db.query(UserSession).filter(
-                UserSession.user_id == user_id,
-                UserSession.session_id == session_id
-            ).update({"is_active": False})
-            db.commit()
-        except Exception as e:
-            print(f"Error clearing session: {e}")
-            db.rollback()
-        finally:
-            db.close()
+        async with AsyncSessionLocal() as db:
+            try:
+                # Only live rows are rewritten; no ORM objects to synchronize
+                await db.execute(
+                    update(UserSession).where(
+                        UserSession.user_id == user_id,
+                        UserSession.session_id == session_id,
+                        UserSession.is_active == True
+                    ).values(is_active=False).execution_options(synchronize_session=False)
+                )
+                await db.commit()
+            except Exception as e:
+                logger.error("Error clearing session: %s", e)
+                await db.rollback()
 
 
 # Global AI agent instance
-ai_agent = AIAgent()
\ No newline at end of file
+ai_agent = AIAgent()
+
+
+def get_ai_agent() -> AIAgent:
+    """FastAPI dependency returning the shared agent and its long-lived clients"""
+    return ai_agent
\ No newline at end of file
@@ -1,17 +1,32 @@
 from fastapi import FastAPI, HTTPException, Depends, BackgroundTasks
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+import hmac
 import uuid
-import time
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import List
+from sqlalchemy import func, select
 
 from ..core.config import settings
-from ..core.database import get_db, User, Conversation, UserSession
-from .models import ChatRequest, ChatResponse, UserInfo, SessionClearRequest
-from .ai_agent import ai_agent
+from ..core.database import async_engine, get_async_db, init_db, new_session_id, User, Conversation, UserSession
+from .models import (
+    STREAM_ERROR_SENTINEL, ChatRequest, ChatResponse, UserInfo, SessionCreateRequest, SessionClearRequest
+)
+from .ai_agent import AIAgent, get_ai_agent
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the schema on startup; stop the batcher and release pooled connections on shutdown"""
+    await init_db()
+    yield
+    await get_ai_agent().batcher.aclose()
+    await async_engine.dispose()
 
-app = FastAPI(title="Telegram AI Bot Backend", version="1.0.0")
+
+app = FastAPI(title="Telegram AI Bot Backend", version="1.0.0", lifespan=lifespan)
 security = HTTPBearer()
 
 # CORS middleware
@@ -25,7 +40,8 @@ app.add_middleware(
 
 
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    if credentials.credentials != settings.API_SECRET_KEY:
+    # Constant-time compare so response timing doesn't leak how much of the key matched
+    if not hmac.compare_digest(credentials.credentials.encode(), settings.API_SECRET_KEY.encode()):
         raise HTTPException(status_code=401, detail="Invalid authentication token")
     return credentials.credentials
 
@@ -34,21 +50,22 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
 async def chat_endpoint(
         request: ChatRequest,
         background_tasks: BackgroundTasks,
+        agent: AIAgent = Depends(get_ai_agent),
         token: str = Depends(verify_token)
 ):
     """Process chat message through AI agent"""
     try:
         # Generate session ID if not provided
         if not request.session_id:
-            request.session_id = f"session_{request.user_id}_{int(time.time())}"
+            request.session_id = new_session_id(request.user_id)
 
         # Process message
-        response = await ai_agent.process_message(
+        response = await agent.process_message(
             user_id=request.user_id,
             message=request.message,
-            session_id=request.session_id
+            session_id=request.session_id,
+            background_tasks=background_tasks
         )
-        print(">>>>ASJKASJS",response)
 
         return response
 
@@ -56,15 +73,53 @@ async def chat_endpoint(
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
 
+@app.post("/chat/stream")
+async def chat_stream_endpoint(
+        request: ChatRequest,
+        background_tasks: BackgroundTasks,
+        agent: AIAgent = Depends(get_ai_agent),
+        token: str = Depends(verify_token)
+):
+    """Stream the AI agent's response as plain-text chunks
+
+    Failures before the first chunk return a 500; later failures end the body with
+    STREAM_ERROR_SENTINEL, since the 200 status has already been sent.
+    """
+    if not request.session_id:
+        request.session_id = new_session_id(request.user_id)
+
+    stream = agent.stream_message(
+        user_id=request.user_id,
+        message=request.message,
+        session_id=request.session_id,
+        background_tasks=background_tasks
+    )
+    try:
+        first = await anext(stream, "")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
+    async def body():
+        yield first
+        try:
+            async for chunk in stream:
+                yield chunk
+        except Exception:
+            yield STREAM_ERROR_SENTINEL
+
+    return StreamingResponse(body(), media_type="text/plain; charset=utf-8")
+
+
 @app.post("/users", response_model=dict)
 async def create_or_update_user(
         user_info: UserInfo,
-        db=Depends(get_db),
+        db=Depends(get_async_db),
         token: str = Depends(verify_token)
 ):
     """Create or update user information"""
     try:
-        user = db.query(User).filter(User.telegram_user_id == user_info.telegram_user_id).first()
+        result = await db.execute(select(User).where(User.telegram_user_id == user_info.telegram_user_id))
+        user = result.scalars().first()
 
         if user:
             # Update existing user
@@ -82,22 +137,37 @@ async def create_or_update_user(
             )
             db.add(user)
 
-        db.commit()
+        await db.commit()
         return {"status": "success", "message": "User updated successfully"}
 
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail=f"Database error: {str(e)}")
 
 
+@app.post("/sessions")
+async def create_session(
+        request: SessionCreateRequest,
+        agent: AIAgent = Depends(get_ai_agent),
+        token: str = Depends(verify_token)
+):
+    """Create a user session and warm its context cache"""
+    try:
+        session_id = await agent.create_session(request.user_id)
+        return {"status": "success", "session_id": session_id}
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error creating session: {str(e)}")
+
+
 @app.post("/sessions/clear")
 async def clear_session(
         request: SessionClearRequest,
+        agent: AIAgent = Depends(get_ai_agent),
         token: str = Depends(verify_token)
 ):
     """Clear user session context"""
     try:
-        await ai_agent.clear_session(request.user_id, request.session_id)
+        await agent.clear_session(request.user_id, request.session_id)
         return {"status": "success", "message": "Session cleared successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error clearing session: {str(e)}")
@@ -106,22 +176,40 @@ async def clear_session(
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    print(">>>>>>>.,",datetime.utcnow())
     return {"status": "healthy", "timestamp": datetime.utcnow()}
 
 
 @app.get("/stats")
-async def get_stats(token: str = Depends(verify_token), db=Depends(get_db)):
+async def get_stats(token: str = Depends(verify_token), db=Depends(get_async_db),
+                    agent: AIAgent = Depends(get_ai_agent)):
     """Get bot statistics"""
     try:
-        total_users = db.query(User).count()
-        total_conversations = db.query(Conversation).count()
-        active_sessions = db.query(UserSession).filter(UserSession.is_active == True).count()
+        # All counts and conversation aggregates in a single round-trip
+        conversations = select(
+            func.count().label("total"),
+            func.coalesce(func.sum(Conversation.tokens_used), 0).label("tokens"),
+            func.avg(Conversation.processing_time).label("avg_processing_time")
+        ).select_from(Conversation).subquery()
+        row = (await db.execute(
+            select(
+                select(func.count()).select_from(User).scalar_subquery().label("total_users"),
+                conversations.c.total,
+                conversations.c.tokens,
+                conversations.c.avg_processing_time,
+                select(func.count()).select_from(UserSession).where(
+                    UserSession.is_active == True
+                ).scalar_subquery().label("active_sessions")
+            )
+        )).one()
 
         return {
-            "total_users": total_users,
-            "total_conversations": total_conversations,
-            "active_sessions": active_sessions,
+            "total_users": row.total_users,
+            "total_conversations": row.total,
+            "active_sessions": row.active_sessions,
+            "total_tokens": row.tokens,
+            "avg_processing_time_ms": round(row.avg_processing_time or 0),
+            "cached_sessions": len(agent.conversation_memory),
+            "prompt_cache": agent.prompt_cache_stats,
             "timestamp": datetime.utcnow()
         }
     except Exception as e:
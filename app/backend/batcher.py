@@ -0,0 +1,77 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List
+
+
+class RequestBatcher:
+    """Coalesce concurrent completion requests and dispatch them with bounded concurrency"""
+
+    def __init__(self, handler: Callable[[List[Dict]], Awaitable[Any]], max_batch_size: int,
+                 batch_timeout: float, max_concurrency: int):
+        self._handler = handler
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout  # seconds to wait for more requests after the first
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self._queue = None
+        self._worker = None
+        self._tasks = set()  # strong references to in-flight batches
+
+    async def submit(self, messages: List[Dict]) -> Any:
+        """Queue a request and wait for the handler's result"""
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((messages, future))
+        return await future
+
+    async def aclose(self):
+        """Stop the worker; requests submitted afterwards start a new one"""
+        worker, self._worker = self._worker, None
+        if worker is None or worker.done() or worker.get_loop() is not asyncio.get_running_loop():
+            return
+        worker.cancel()
+        try:
+            await worker
+        except asyncio.CancelledError:
+            pass
+
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._worker.done() or self._worker.get_loop() is not loop:
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.batch_timeout
+
+            # Drain whatever is already queued, then wait out the window for more
+            while len(batch) < self.max_batch_size:
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+
+            task = loop.create_task(self._dispatch_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _dispatch_batch(self, batch):
+        await asyncio.gather(*(self._dispatch(messages, future) for messages, future in batch))
+
+    async def _dispatch(self, messages: List[Dict], future: asyncio.Future):
+        async with self.semaphore:
+            try:
+                result = await self._handler(messages)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
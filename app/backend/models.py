@@ -2,6 +2,10 @@ from pydantic import BaseModel
 from typing import Optional
 from datetime import datetime
 
+# Ends a /chat/stream body early when generation fails after the response has started;
+# NUL never occurs in model text, so clients can tell it from content
+STREAM_ERROR_SENTINEL = "\x00"
+
 class ChatRequest(BaseModel):
     user_id: int
     message: str
@@ -21,6 +25,9 @@ class UserInfo(BaseModel):
     first_name: Optional[str] = None
     last_name: Optional[str] = None
 
+class SessionCreateRequest(BaseModel):
+    user_id: int
+
 class SessionClearRequest(BaseModel):
     user_id: int
     session_id: str
\ No newline at end of file
@@ -0,0 +1,78 @@
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import orjson
+
+from ..core.config import settings
+
+
+class SemanticCache:
+    """LRU cache of AI responses matched by embedding similarity of the user message"""
+
+    def __init__(self, embed: Optional[Callable] = None, threshold: float = None, max_entries: int = None):
+        self._embed = embed
+        self.threshold = threshold if threshold is not None else settings.SEMANTIC_CACHE_THRESHOLD
+        self.max_entries = max_entries if max_entries is not None else settings.SEMANTIC_CACHE_MAX_ENTRIES
+        self._entries = OrderedDict()  # (context_hash, message) -> (embedding, response)
+        self._last_embedding = (None, None)  # reused between lookup() and store() of a miss
+
+    def _embedder(self) -> Callable:
+        """Load the sentence-transformers model on first use"""
+        if self._embed is None:
+            from sentence_transformers import SentenceTransformer
+
+            model = SentenceTransformer(settings.SEMANTIC_CACHE_MODEL)
+            self._embed = lambda text: model.encode(text, normalize_embeddings=True)
+        return self._embed
+
+    def _encode(self, message: str):
+        return self._embedder()(message)
+
+    async def _embedding(self, message: str):
+        """Embed off the event loop; model loading and inference are CPU-bound"""
+        if self._last_embedding[0] != message:
+            self._last_embedding = (message, await asyncio.to_thread(self._encode, message))
+        return self._last_embedding[1]
+
+    @staticmethod
+    def _context_hash(context: List[Dict]) -> str:
+        return hashlib.sha256(orjson.dumps(context, option=orjson.OPT_SORT_KEYS)).hexdigest()[:16]
+
+    def is_eligible(self, context: List[Dict]) -> bool:
+        """Only short conversations are cached to avoid history-dependent false hits"""
+        return len(context) < settings.HISTORY_THRESHOLD
+
+    async def lookup(self, message: str, context: List[Dict]) -> Optional[str]:
+        """Return the cached response of the most similar message, if above threshold"""
+        if not self.is_eligible(context) or not self._entries:
+            return None
+
+        context_hash = self._context_hash(context)
+        embedding = await self._embedding(message)
+
+        best_key, best_score = None, self.threshold
+        for key, (cached_embedding, _) in self._entries.items():
+            if key[0] != context_hash:
+                continue
+            score = float(embedding.dot(cached_embedding))
+            if score >= best_score:
+                best_key, best_score = key, score
+
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key][1]
+
+    async def store(self, message: str, context: List[Dict], response: str):
+        """Insert a generated response, evicting the least recently used entry"""
+        if not self.is_eligible(context):
+            return
+
+        key = (self._context_hash(context), message)
+        embedding = await self._embedding(message)
+        self._entries[key] = (embedding, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
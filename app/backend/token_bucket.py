@@ -0,0 +1,43 @@
+import asyncio
+import time
+
+
+class AsyncTokenBucket:
+    """Client-side limiter for provider tokens-per-minute and requests-per-minute quotas"""
+
+    def __init__(self, tokens_per_minute: int, requests_per_minute: int):
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self._tokens = float(tokens_per_minute)
+        self._requests = float(requests_per_minute)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._updated
+        self._updated = now
+        self._tokens = min(self.tokens_per_minute, self._tokens + elapsed * self.tokens_per_minute / 60)
+        self._requests = min(self.requests_per_minute, self._requests + elapsed * self.requests_per_minute / 60)
+
+    async def acquire(self, tokens: int):
+        """Wait until one request and the estimated tokens fit in the budget"""
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= tokens and self._requests >= 1:
+                    self._tokens -= tokens
+                    self._requests -= 1
+                    return
+
+                wait = max(
+                    (tokens - self._tokens) * 60 / self.tokens_per_minute,
+                    (1 - self._requests) * 60 / self.requests_per_minute
+                )
+                await asyncio.sleep(wait)
+
+    def reconcile(self, estimated: int, actual: int):
+        """Refund or charge the difference between estimated and reported token usage"""
+        self._refill()
+        self._tokens = min(self.tokens_per_minute, self._tokens + estimated - actual)
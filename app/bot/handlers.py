@@ -1,60 +1,30 @@
 import asyncio
+import codecs
 import logging
+import string
+import time
 
 import aiohttp
 import uuid
-from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from typing import Dict
+from typing import AsyncIterator, Dict, Final
+from sqlalchemy import func, select, true
 
 from ..core.config import settings
-from ..core.database import get_db, User, Conversation
-from .middleware import rate_limiter, access_control
-
-# Configure logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=getattr(logging, settings.LOG_LEVEL),
-    handlers=[
-        logging.FileHandler(settings.LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+from ..backend.models import STREAM_ERROR_SENTINEL
+from ..core.database import AsyncSessionLocal, User, Conversation, new_session_id
+from .middleware import protected
+from .utils import TELEGRAM_MESSAGE_LIMIT, split_message
 
 logger = logging.getLogger(__name__)
 
-class BotHandlers:
-    def __init__(self):
-        self.api_base_url = f"http://localhost:{settings.API_PORT}"
-        self.session = None
-        self.user_sessions: Dict[int, str] = {}  # user_id -> session_id
-
-    async def init_session(self):
-        """Initialize HTTP session"""
-        if not self.session:
-            self.session = aiohttp.ClientSession()
-
-    async def close_session(self):
-        """Close HTTP session"""
-        if self.session:
-            await self.session.close()
-
-    # @access_control
-    # @rate_limiter
-    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /start command"""
-        print("ishladiiIIIIIIIIII")
-        user = update.effective_user
-        logger.debug("Start command triggered by user: %s", user)
-
-        # Create/update user in backend
-        await self._update_user_info(user)
+STREAM_EDIT_INTERVAL = 0.4  # seconds between edits of a streamed reply
 
-        welcome_message = f"""
+WELCOME_TEMPLATE = string.Template("""
 🤖 **Welcome to AI Assistant Bot!**
 
-Hello {user.first_name}! I'm your AI assistant powered by advanced language models.
+Hello $first_name! I'm your AI assistant powered by advanced language models.
 
 **Available Commands:**
 • Send any message - I'll respond intelligently
@@ -70,25 +40,9 @@ Just type your question or message, and I'll help you with:
 ✅ And much more!
 
 Let's get started! 🚀
-        """
-
-        keyboard = [
-            [InlineKeyboardButton("📊 My Stats", callback_data="user_stats")],
-            [InlineKeyboardButton("❓ Help", callback_data="help")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+""")
 
-        await update.message.reply_text(
-            welcome_message,
-            parse_mode='Markdown',
-            reply_markup=reply_markup
-        )
-
-    # @access_control
-    # @rate_limiter
-    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Handle /help command"""
-        help_message = """
+HELP_MESSAGE: Final[str] = """
 🤖 **AI Assistant Bot Help**
 
 **Commands:**
@@ -110,12 +64,78 @@ Let's get started! 🚀
 • Check /stats to see your usage
 
 **Need more help?** Just ask me anything!
-        """
+"""
+
+# Inline keyboards are immutable and identical for every user
+START_KEYBOARD: Final[InlineKeyboardMarkup] = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📊 My Stats", callback_data="user_stats")],
+    [InlineKeyboardButton("❓ Help", callback_data="help")]
+])
+
+
+class BackendError(Exception):
+    """Raised when the AI backend cannot produce a response"""
 
-        await update.message.reply_text(help_message, parse_mode='Markdown')
 
-    # @access_control
-    # @rate_limiter
+class BotHandlers:
+    def __init__(self):
+        self.api_base_url = f"http://localhost:{settings.API_PORT}"
+        self.session = None
+        self._session_lock = asyncio.Lock()
+        self.user_sessions: Dict[int, str] = {}  # user_id -> session_id
+        self._background_tasks = set()
+
+    async def init_session(self):
+        """Initialize the shared, keep-alive HTTP session"""
+        if self.session:
+            return
+        async with self._session_lock:
+            if not self.session:
+                self.session = aiohttp.ClientSession(
+                    connector=aiohttp.TCPConnector(
+                        limit=200,
+                        limit_per_host=64,
+                        keepalive_timeout=75,
+                        ttl_dns_cache=300
+                    ),
+                    timeout=aiohttp.ClientTimeout(total=60)
+                )
+
+    async def close_session(self):
+        """Close HTTP session"""
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    @protected
+    async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /start command"""
+        user = update.effective_user
+        logger.debug("Start command triggered by user: %s", user)
+
+        # Create/update user in backend
+        await self._update_user_info(user)
+
+        # Pre-create the session so the first message skips a cold context load
+        if user.id not in self.user_sessions:
+            task = asyncio.create_task(self._prewarm_session(user.id))
+            self._background_tasks.add(task)
+            task.add_done_callback(self._background_tasks.discard)
+
+        welcome_message = WELCOME_TEMPLATE.substitute(first_name=user.first_name)
+
+        await update.message.reply_text(
+            welcome_message,
+            parse_mode='Markdown',
+            reply_markup=START_KEYBOARD
+        )
+
+    @protected
+    async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Handle /help command"""
+        await update.message.reply_text(HELP_MESSAGE, parse_mode='Markdown')
+
+    @protected
     async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /clear command"""
         user_id = update.effective_user.id
@@ -127,15 +147,14 @@ Let's get started! 🚀
             await self._clear_session(user_id, session_id)
 
             # Generate new session ID
-            self.user_sessions[user_id] = f"session_{user_id}_{int(datetime.now().timestamp())}"
+            self.user_sessions[user_id] = new_session_id(user_id)
 
         await update.message.reply_text(
             "🧹 **Conversation cleared!**\n\nYour chat history has been reset. Let's start fresh!",
             parse_mode='Markdown'
         )
 
-    # @access_control
-    # @rate_limiter
+    @protected
     async def stats_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /stats command"""
         user_id = update.effective_user.id
@@ -148,6 +167,7 @@ Let's get started! 🚀
 
 • **Messages sent:** {stats.get('total_messages', 0)}
 • **Responses received:** {stats.get('total_responses', 0)}
+• **Tokens used:** {stats.get('total_tokens', 0)}
 • **Active since:** {stats.get('member_since', 'Unknown')}
 • **Last activity:** {stats.get('last_activity', 'Now')}
 
@@ -156,8 +176,7 @@ Keep chatting to learn more! 🚀
 
         await update.message.reply_text(stats_message, parse_mode='Markdown')
 
-    # @access_control
-    # @rate_limiter
+    @protected
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle regular text messages"""
         user_id = update.effective_user.id
@@ -168,36 +187,52 @@ Keep chatting to learn more! 🚀
 
         # Get or create session ID
         if user_id not in self.user_sessions:
-            self.user_sessions[user_id] = f"session_{user_id}_{int(datetime.now().timestamp())}"
+            self.user_sessions[user_id] = new_session_id(user_id)
 
         session_id = self.user_sessions[user_id]
 
         try:
-            # Send message to AI backend
-            response = await self._send_to_ai_backend(user_id, message_text, session_id)
-
-            if response and response.get('success'):
-                ai_response = response['response']
-
-                # Split long messages
-                if len(ai_response) > 4096:
-                    # Split message into chunks
-                    chunks = [ai_response[i:i + 4096] for i in range(0, len(ai_response), 4096)]
-                    for chunk in chunks:
-                        await update.message.reply_text(chunk)
-                else:
-                    await update.message.reply_text(ai_response)
-            else:
-                error_msg = response.get('error', 'Unknown error occurred')
-                await update.message.reply_text(
-                    f"❌ Sorry, I encountered an error: {error_msg}\n\nPlease try again or contact support."
-                )
-
+            # Stream the AI response, editing the reply as chunks arrive
+            reply = None
+            parts = []
+            shown = ""
+            last_edit = 0.0
+
+            async for chunk in self._stream_from_ai_backend(user_id, message_text, session_id):
+                parts.append(chunk)
+                now = time.monotonic()
+                if reply is None:
+                    shown = "".join(parts)[:TELEGRAM_MESSAGE_LIMIT]
+                    reply = await update.message.reply_text(shown)
+                    last_edit = now
+                elif now - last_edit >= STREAM_EDIT_INTERVAL:
+                    text = "".join(parts)[:TELEGRAM_MESSAGE_LIMIT]
+                    if text != shown:
+                        await reply.edit_text(text)
+                        shown = text
+                        last_edit = now
+
+            ai_response = "".join(parts)
+            if reply is None:
+                raise BackendError("Empty response")
+
+            # Settle the first message and send the remainder of long responses
+            chunks = split_message(ai_response)
+            first = next(chunks)
+            if first != shown:
+                await reply.edit_text(first)
+            for chunk in chunks:
+                await update.message.reply_text(chunk)
+
+        except BackendError as e:
+            await update.message.reply_text(
+                f"❌ Sorry, I encountered an error: {e}\n\nPlease try again or contact support."
+            )
         except Exception as e:
             await update.message.reply_text(
                 "❌ I'm temporarily unavailable. Please try again in a moment."
             )
-            print(f"Error handling message: {e}")
+            logger.error("Error handling message: %s", e)
 
     async def button_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle inline keyboard button callbacks"""
@@ -209,38 +244,45 @@ Keep chatting to learn more! 🚀
         elif query.data == "user_stats":
             await self.stats_command(update, context)
 
-    async def _send_to_ai_backend(self, user_id: int, message: str, session_id: str) -> dict:
-        """Send message to AI backend API"""
+    async def _stream_from_ai_backend(self, user_id: int, message: str, session_id: str) -> AsyncIterator[str]:
+        """Stream the AI response text from the backend API"""
         await self.init_session()
 
-        try:
-            headers = {
-                "Authorization": f"Bearer {settings.API_SECRET_KEY}",
-                "Content-Type": "application/json"
-            }
+        headers = {
+            "Authorization": f"Bearer {settings.API_SECRET_KEY}",
+            "Content-Type": "application/json"
+        }
 
-            payload = {
-                "user_id": user_id,
-                "message": message,
-                "session_id": session_id
-            }
+        payload = {
+            "user_id": user_id,
+            "message": message,
+            "session_id": session_id
+        }
 
+        try:
             async with self.session.post(
-                    f"{self.api_base_url}/chat",
+                    f"{self.api_base_url}/chat/stream",
                     json=payload,
                     headers=headers,
                     timeout=aiohttp.ClientTimeout(total=60)
             ) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
+                if response.status != 200:
                     error_text = await response.text()
-                    return {"success": False, "error": f"API error: {error_text}"}
+                    raise BackendError(f"API error: {error_text}")
+
+                decoder = codecs.getincrementaldecoder("utf-8")()
+                async for data in response.content.iter_any():
+                    text = decoder.decode(data)
+                    text, interrupted, _ = text.partition(STREAM_ERROR_SENTINEL)
+                    if text:
+                        yield text
+                    if interrupted:
+                        raise BackendError("Response interrupted")
 
         except asyncio.TimeoutError:
-            return {"success": False, "error": "Request timeout"}
-        except Exception as e:
-            return {"success": False, "error": f"Connection error: {str(e)}"}
+            raise BackendError("Request timeout")
+        except aiohttp.ClientError as e:
+            raise BackendError(f"Connection error: {str(e)}")
 
     async def _clear_session(self, user_id: int, session_id: str):
         """Clear user session via API"""
@@ -265,7 +307,30 @@ Keep chatting to learn more! 🚀
                 pass  # Just fire and forget
 
         except Exception as e:
-            print(f"Error clearing session: {e}")
+            logger.error("Error clearing session: %s", e)
+
+    async def _prewarm_session(self, user_id: int):
+        """Create a backend session ahead of the user's first message"""
+        await self.init_session()
+
+        try:
+            headers = {
+                "Authorization": f"Bearer {settings.API_SECRET_KEY}",
+                "Content-Type": "application/json"
+            }
+
+            async with self.session.post(
+                    f"{self.api_base_url}/sessions",
+                    json={"user_id": user_id},
+                    headers=headers
+            ) as response:
+                if response.status == 200:
+                    data = await response.json()
+                    # Keep any session the user started while this was in flight
+                    self.user_sessions.setdefault(user_id, data["session_id"])
+
+        except Exception as e:
+            logger.error("Error prewarming session: %s", e)
 
     async def _update_user_info(self, user):
         """Update user information via API"""
@@ -292,26 +357,38 @@ Keep chatting to learn more! 🚀
                 pass  # Just fire and forget
 
         except Exception as e:
-            print(f"Error updating user info: {e}")
+            logger.error("Error updating user info: %s", e)
 
     async def _get_user_stats(self, user_id: int) -> dict:
         """Get user statistics from database"""
-        db = next(get_db())
-        try:
-            user = db.query(User).filter(User.telegram_user_id == user_id).first()
-            if user:
-                return {
-                    "total_messages": db.query(Conversation).filter(Conversation.user_id == user_id).count(),
-                    "total_responses": db.query(Conversation).filter(Conversation.user_id == user_id).count(),
-                    "member_since": user.created_at.strftime("%Y-%m-%d"),
-                    "last_activity": user.last_seen.strftime("%Y-%m-%d %H:%M")
-                }
-            return {}
-        except Exception as e:
-            print(f"Error getting user stats: {e}")
-            return {}
-        finally:
-            db.close()
+        async with AsyncSessionLocal() as db:
+            try:
+                # Only the columns shown, with the conversation aggregates, in one round-trip
+                conversations = select(
+                    func.count().label("total_messages"),
+                    func.coalesce(func.sum(Conversation.tokens_used), 0).label("total_tokens")
+                ).where(Conversation.user_id == user_id).subquery()
+                row = (await db.execute(
+                    select(
+                        User.created_at,
+                        User.last_seen,
+                        conversations.c.total_messages,
+                        conversations.c.total_tokens
+                    ).join_from(User, conversations, true()).where(User.telegram_user_id == user_id)
+                )).first()
+                if row:
+                    # Every logged conversation row is one message and its response
+                    return {
+                        "total_messages": row.total_messages,
+                        "total_responses": row.total_messages,
+                        "total_tokens": row.total_tokens,
+                        "member_since": row.created_at.strftime("%Y-%m-%d"),
+                        "last_activity": row.last_seen.strftime("%Y-%m-%d %H:%M")
+                    }
+                return {}
+            except Exception as e:
+                logger.error("Error getting user stats: %s", e)
+                return {}
 
 
 # Global handlers instance
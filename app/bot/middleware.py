@@ -1,85 +1,102 @@
 import time
+from collections import OrderedDict
 from functools import wraps
-from collections import defaultdict, deque
-from datetime import datetime, timedelta
+from typing import Final, Tuple
 from telegram import Update
-from telegram.ext import ContextTypes
 
 from ..core.config import settings
 
-# Rate limiting storage
-user_message_times = defaultdict(deque)
+# Rejection replies, rendered once; settings are fixed for the process lifetime
+RATE_LIMIT_MESSAGE: Final[str] = (
+    f"⚠️ **Rate limit exceeded!**\n\n"
+    f"Please wait a moment before sending another message.\n"
+    f"Limit: {settings.RATE_LIMIT_MESSAGES} messages per {settings.RATE_LIMIT_WINDOW} seconds."
+)
+ACCESS_DENIED_MESSAGE: Final[str] = (
+    "🚫 **Access Denied**\n\n"
+    "You don't have permission to use this bot.\n"
+    "Please contact the administrator for access."
+)
+ADMIN_REQUIRED_MESSAGE: Final[str] = (
+    "🚫 **Admin Access Required**\n\n"
+    "This command requires administrator privileges."
+)
+REJECTION_REPLY_OPTIONS: Final[dict] = {"disable_notification": True, "disable_web_page_preview": True}
 
+# Rate limiting storage: user_id -> (window start, messages in window), least recent first
+user_message_windows: "OrderedDict[int, Tuple[float, int]]" = OrderedDict()
 
-def rate_limiter(func):
-    """Rate limiting decorator"""
 
-    @wraps(func)
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user_id = update.effective_user.id
-        current_time = datetime.now()
+def _evict_stale_windows(now: float):
+    """Drop least recently seen users whose window has elapsed or who exceed the cap"""
+    while user_message_windows:
+        user_id, (window_start, _) = next(iter(user_message_windows.items()))
+        if (now - window_start < settings.RATE_LIMIT_WINDOW
+                and len(user_message_windows) <= settings.RATE_LIMIT_MAX_TRACKED_USERS):
+            break
+        del user_message_windows[user_id]
 
-        # Clean old messages outside window
-        window_start = current_time - timedelta(seconds=settings.RATE_LIMIT_WINDOW)
-        user_times = user_message_times[user_id]
 
-        while user_times and user_times[0] < window_start:
-            user_times.popleft()
+def _update_from(args) -> Update:
+    """Handlers are called as (update, context) or, for methods, (self, update, context)"""
+    return args[-2]
 
-        # Check rate limit
-        if len(user_times) >= settings.RATE_LIMIT_MESSAGES:
-            await update.message.reply_text(
-                f"⚠️ **Rate limit exceeded!**\n\n"
-                f"Please wait a moment before sending another message.\n"
-                f"Limit: {settings.RATE_LIMIT_MESSAGES} messages per {settings.RATE_LIMIT_WINDOW} seconds."
-            )
-            return
 
-        # Add current message time
-        user_times.append(current_time)
+def _is_whitelisted(user_id: int) -> bool:
+    return not settings.WHITELISTED_USERS or user_id in settings.WHITELISTED_USERS
 
-        return await func(update, context, *args, **kwargs)
 
-    return wrapper
+def _allow_message(user_id: int) -> bool:
+    """Count a message against the user's fixed window; False once the limit is reached"""
+    now = time.monotonic()
+    _evict_stale_windows(now)
 
+    # Start a new fixed window once the current one has elapsed
+    window_start, count = user_message_windows.get(user_id, (now, 0))
+    if now - window_start >= settings.RATE_LIMIT_WINDOW:
+        window_start, count = now, 0
 
-def access_control(func):
-    """Access control decorator"""
+    if count >= settings.RATE_LIMIT_MESSAGES:
+        return False
 
-    @wraps(func)
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user_id = update.effective_user.id
+    user_message_windows[user_id] = (window_start, count + 1)
+    user_message_windows.move_to_end(user_id)
+    return True
 
-        # Check whitelist if configured
-        if settings.WHITELISTED_USERS and user_id not in settings.WHITELISTED_USERS:
-            await update.message.reply_text(
-                "🚫 **Access Denied**\n\n"
-                "You don't have permission to use this bot.\n"
-                "Please contact the administrator for access."
-            )
-            return
 
-        return await func(update, context, *args, **kwargs)
+async def _reject_unauthorized(update: Update):
+    # Replying to strangers costs an API call and invites flood limits
+    if not settings.SILENT_REJECT_UNAUTHORIZED:
+        await update.message.reply_text(ACCESS_DENIED_MESSAGE, **REJECTION_REPLY_OPTIONS)
 
-    return wrapper
 
+def protected(func=None, *, admin: bool = False, rate_limit: bool = True):
+    """Combined access control, optional admin check and rate limiting
 
-def admin_only(func):
-    """Admin-only decorator"""
+    Resolves the user once and runs the cheapest rejections first; use as
+    @protected or @protected(admin=True, rate_limit=False).
+    """
+    def decorate(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            update = _update_from(args)
+            user_id = update.effective_user.id
 
-    @wraps(func)
-    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
-        user_id = update.effective_user.id
+            if not _is_whitelisted(user_id):
+                await _reject_unauthorized(update)
+                return
 
-        if user_id not in settings.ADMIN_USER_IDS:
-            await update.message.reply_text(
-                "🚫 **Admin Access Required**\n\n"
-                "This command requires administrator privileges."
-            )
-            return
+            if admin and user_id not in settings.ADMIN_USER_IDS:
+                await update.message.reply_text(ADMIN_REQUIRED_MESSAGE, **REJECTION_REPLY_OPTIONS)
+                return
 
-        return await func(update, context, *args, **kwargs)
+            if rate_limit and not _allow_message(user_id):
+                await update.message.reply_text(RATE_LIMIT_MESSAGE, **REJECTION_REPLY_OPTIONS)
+                return
 
-    return wrapper
+            return await func(*args, **kwargs)
 
+        return wrapper
+
+    return decorate(func) if func is not None else decorate
 
@@ -0,0 +1,26 @@
+from typing import Iterator
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> Iterator[str]:
+    """Yield Telegram-sized chunks of text, preferring paragraph and line boundaries"""
+    if len(text) <= limit:
+        yield text
+        return
+
+    start = 0
+    while len(text) - start > limit:
+        end = start + limit
+        cut = text.rfind("\n\n", start, end)
+        if cut <= start:
+            cut = text.rfind("\n", start, end)
+        if cut <= start:
+            cut = end
+        yield text[start:cut]
+        start = cut
+        # Drop the separator so continuation messages don't start blank
+        while start < len(text) and text[start] == "\n":
+            start += 1
+    if start < len(text):
+        yield text[start:]
@@ -1,10 +1,16 @@
+import logging
 import os
-from typing import List, Optional
-from pydantic_settings import BaseSettings
-from pydantic import Field
+from functools import lru_cache
+from typing import FrozenSet, Optional, Union
+from pydantic_settings import BaseSettings, SettingsConfigDict
+from pydantic import Field, ValidationError, field_validator
+
+logger = logging.getLogger(__name__)
 
 
 class Settings(BaseSettings):
+    model_config = SettingsConfigDict(env_file=".env", case_sensitive=True)
+
     # Telegram Bot Settings
     TELEGRAM_BOT_TOKEN: str = Field(..., env="TELEGRAM_BOT_TOKEN")
     TELEGRAM_WEBHOOK_URL: Optional[str] = Field(None, env="TELEGRAM_WEBHOOK_URL")
@@ -16,6 +22,26 @@ class Settings(BaseSettings):
     GROQ_API_KEY: str = Field(..., env="GROQ_API_KEY")
     GROQ_AI_MODEL: str = Field("llama-3.3-70b-versatile", env="GROQ_AI_MODEL")
 
+    # LLM Request Batching
+    BATCH_SIZE_MAX: int = Field(8, env="BATCH_SIZE_MAX")
+    BATCH_TIMEOUT_MS: int = Field(0, env="BATCH_TIMEOUT_MS")  # coalescing window after the first request
+    LLM_MAX_CONCURRENCY: int = Field(32, env="LLM_MAX_CONCURRENCY")
+    MAX_TOKENS_PER_MIN: int = Field(200_000, env="MAX_TOKENS_PER_MIN")  # provider TPM quota
+    MAX_REQUESTS_PER_MIN: int = Field(1200, env="MAX_REQUESTS_PER_MIN")  # provider RPM quota
+
+    # Conversation Context
+    CONTEXT_MAX_MESSAGES: int = Field(20, env="CONTEXT_MAX_MESSAGES")
+    CONTEXT_PINNED_MESSAGES: int = Field(4, env="CONTEXT_PINNED_MESSAGES")  # kept after system prompt for prompt caching
+    SESSION_CACHE_MAX: int = Field(10_000, env="SESSION_CACHE_MAX")
+    SESSION_TTL_S: int = Field(3600, env="SESSION_TTL_S")  # seconds
+
+    # Semantic Response Cache
+    SEMANTIC_CACHE_ENABLED: bool = Field(False, env="SEMANTIC_CACHE_ENABLED")
+    SEMANTIC_CACHE_MODEL: str = Field("sentence-transformers/all-MiniLM-L6-v2", env="SEMANTIC_CACHE_MODEL")
+    SEMANTIC_CACHE_THRESHOLD: float = Field(0.92, env="SEMANTIC_CACHE_THRESHOLD")  # cosine similarity
+    SEMANTIC_CACHE_MAX_ENTRIES: int = Field(1000, env="SEMANTIC_CACHE_MAX_ENTRIES")
+    HISTORY_THRESHOLD: int = Field(3, env="HISTORY_THRESHOLD")  # max context messages eligible for caching
+
     # Backend API Settings
     API_HOST: str = Field("0.0.0.0", env="API_HOST")
     API_PORT: int = Field(8000, env="API_PORT")
@@ -23,22 +49,47 @@ class Settings(BaseSettings):
 
     # Database Settings
     DATABASE_URL: str = Field("sqlite:///./telegram_bot.db", env="DATABASE_URL")
+    DB_POOL_SIZE: int = Field(20, env="DB_POOL_SIZE")
+    DB_MAX_OVERFLOW: int = Field(40, env="DB_MAX_OVERFLOW")
+    DB_POOL_RECYCLE_S: int = Field(1800, env="DB_POOL_RECYCLE_S")  # seconds
+    PERSIST_MAX_CONCURRENCY: int = Field(100, env="PERSIST_MAX_CONCURRENCY")  # background turn writes
 
-    # Access Control
-    WHITELISTED_USERS: List[int] = Field(default_factory=list, env="WHITELISTED_USERS")
-    ADMIN_USER_IDS: List[int] = Field(default_factory=list, env="ADMIN_USER_IDS")
+    # Access Control (comma-separated or JSON list; str lets non-JSON values reach the validator)
+    WHITELISTED_USERS: Union[FrozenSet[int], str] = Field(default_factory=frozenset, env="WHITELISTED_USERS")
+    ADMIN_USER_IDS: Union[FrozenSet[int], str] = Field(default_factory=frozenset, env="ADMIN_USER_IDS")
+    SILENT_REJECT_UNAUTHORIZED: bool = Field(False, env="SILENT_REJECT_UNAUTHORIZED")  # drop without replying
 
     # Logging
     LOG_LEVEL: str = Field("INFO", env="LOG_LEVEL")
     LOG_FILE: str = Field("bot.log", env="LOG_FILE")
+    LOG_JSON: bool = Field(False, env="LOG_JSON")  # JSON lines in the log file
 
     # Rate Limiting
     RATE_LIMIT_MESSAGES: int = Field(10, env="RATE_LIMIT_MESSAGES")
     RATE_LIMIT_WINDOW: int = Field(60, env="RATE_LIMIT_WINDOW")  # seconds
+    RATE_LIMIT_MAX_TRACKED_USERS: int = Field(100_000, env="RATE_LIMIT_MAX_TRACKED_USERS")
+
+    @field_validator("WHITELISTED_USERS", "ADMIN_USER_IDS", mode="before")
+    @classmethod
+    def parse_user_ids(cls, value) -> FrozenSet[int]:
+        """Build an O(1) membership set of user IDs"""
+        if isinstance(value, int):
+            return frozenset([value])
+        if isinstance(value, str):
+            return frozenset(int(user_id) for user_id in value.split(",") if user_id.strip())
+        return frozenset(value)
+
 
-    class Config:
-        env_file = ".env"
-        case_sensitive = True
+@lru_cache
+def get_settings() -> Settings:
+    """Parse the environment once and share the result; exits with one log line per invalid setting"""
+    try:
+        return Settings()
+    except ValidationError as e:
+        # Runs before setup_logging(); logging's last-resort handler still prints to stderr
+        for error in e.errors():
+            logger.error("Invalid setting %s: %s", ".".join(map(str, error["loc"])), error["msg"])
+        raise SystemExit("Invalid configuration, see the errors above") from None
 
 
-settings = Settings()
\ No newline at end of file
+settings = get_settings()
\ No newline at end of file
@@ -1,15 +1,61 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text, Boolean
+from sqlalchemy import event, func, Column, Integer, String, DateTime, Text, Boolean, Index, LargeBinary
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
 from datetime import datetime
 import json
+import time
 
 from .config import settings
 
-engine = create_engine(settings.DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+
+def _async_engine_options(url):
+    """Build the asyncio driver URL and pool options for the configured database"""
+    url = make_url(url)
+    backend = url.get_backend_name()
+    url = url.set(drivername=ASYNC_DRIVERS.get(backend, url.drivername))
+    options = {"pool_pre_ping": True}
+    if backend == "sqlite" and url.database in (None, "", ":memory:"):
+        # Each connection to :memory: is a separate database; share one instead
+        options["poolclass"] = StaticPool
+    elif backend != "sqlite":
+        options.update(
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_recycle=settings.DB_POOL_RECYCLE_S
+        )
+    return url, options
+
+
+def _enable_sqlite_wal(dbapi_connection, connection_record):
+    """Let readers proceed during writes and fsync on checkpoints rather than every commit"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+async_database_url, async_engine_options = _async_engine_options(settings.DATABASE_URL)
+async_engine = create_async_engine(async_database_url, **async_engine_options)
+
+if async_engine.dialect.name == "sqlite":
+    event.listen(async_engine.sync_engine, "connect", _enable_sqlite_wal)
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+
+def new_session_id(user_id: int) -> str:
+    """Time-ordered session ID: new rows append to the right edge of the session_id index
+
+    Fixed-width hex nanoseconds keep lexical and chronological order aligned and avoid
+    collisions when a user starts two sessions within the same second.
+    """
+    return f"session_{time.time_ns():016x}_{user_id}"
+
 
 class User(Base):
     __tablename__ = "users"
@@ -32,10 +78,20 @@ class Conversation(Base):
     session_id = Column(String, index=True)
     message = Column(Text)
     response = Column(Text)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    # Set in UTC by the ORM like the other timestamps; the server default only covers raw SQL inserts
+    timestamp = Column(DateTime, default=datetime.utcnow, server_default=func.now())
     tokens_used = Column(Integer, default=0)
     processing_time = Column(Integer, default=0)  # milliseconds
 
+    __table_args__ = (
+        # Serves per-session history lookups newest-first without a sort
+        Index("ix_conv_user_session_ts", "user_id", "session_id", timestamp.desc()),
+        # Serves per-user history and time-bounded stats across sessions
+        Index("ix_conv_user_ts", "user_id", "timestamp"),
+        # Covers per-user message count and token sum as an index-only scan
+        Index("ix_conv_user_tokens", "user_id", "tokens_used"),
+    )
+
 
 class UserSession(Base):
     __tablename__ = "user_sessions"
@@ -43,19 +99,28 @@ class UserSession(Base):
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, index=True)
     session_id = Column(String, unique=True, index=True)
-    context = Column(Text)  # JSON string
+    context = Column(LargeBinary)  # zlib-compressed JSON
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow)
     is_active = Column(Boolean, default=True)
 
+    __table_args__ = (
+        # Partial index: active-session counts and lookups only touch live rows
+        Index(
+            "ix_user_sessions_active_user",
+            "user_id",
+            postgresql_where=is_active == True,
+            sqlite_where=is_active == True,
+        ),
+    )
+
 
-# Create tables
-Base.metadata.create_all(bind=engine)
+async def init_db():
+    """Create missing tables; called once at application startup"""
+    async with async_engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
\ No newline at end of file
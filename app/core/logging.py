@@ -1,47 +1,91 @@
+import atexit
 import logging
 import logging.handlers
+import queue
+from contextvars import ContextVar
 from pathlib import Path
+from typing import Optional
+
+import orjson
+
 from .config import settings
 
+# Telegram user whose update is being handled in the current task
+user_id_var: ContextVar[Optional[int]] = ContextVar("user_id", default=None)
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - [user %(user_id)s] %(message)s'
+
+# Background thread that drains queued records to the real handlers
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class UserContextFilter(logging.Filter):
+    """Stamp records with the current user_id; runs in the logging caller's context"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        user_id = user_id_var.get()
+        record.user_id = "-" if user_id is None else user_id
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line for log shippers"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        user_id = getattr(record, "user_id", "-")
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "user_id": None if user_id == "-" else user_id,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(entry, default=str).decode()
+
 
 def setup_logging():
-    """Setup comprehensive logging configuration"""
+    """Setup comprehensive logging configuration
+
+    Loggers only enqueue records; file and console writes happen on a listener thread
+    so the event loop never blocks on log I/O.
+    """
+    global _listener
+    if _listener is not None:
+        # Already configured; a second listener would write every record twice
+        return logging.getLogger(__name__)
 
     # Create logs directory if it doesn't exist
     log_dir = Path("logs")
     log_dir.mkdir(exist_ok=True)
 
-    # Configure root logger
-    logging.basicConfig(
-        level=getattr(logging, settings.LOG_LEVEL.upper()),
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-
-    # File handler with rotation
-    file_handler = logging.handlers.RotatingFileHandler(
-        log_dir / settings.LOG_FILE,
-        maxBytes=10 * 1024 * 1024,  # 10MB
-        backupCount=5
-    )
+    # File handler; rotation is left to logrotate, the handler reopens the file once it moves
+    file_handler = logging.handlers.WatchedFileHandler(log_dir / settings.LOG_FILE)
     file_handler.setLevel(logging.INFO)
-    file_formatter = logging.Formatter(
-        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+    file_formatter = JsonFormatter() if settings.LOG_JSON else logging.Formatter(LOG_FORMAT)
     file_handler.setFormatter(file_formatter)
 
     # Console handler
     console_handler = logging.StreamHandler()
     console_handler.setLevel(getattr(logging, settings.LOG_LEVEL.upper()))
     console_formatter = logging.Formatter(
-        '%(levelname)s - %(name)s - %(message)s'
+        '%(levelname)s - %(name)s - [user %(user_id)s] %(message)s'
     )
     console_handler.setFormatter(console_formatter)
 
-    # Add handlers to root logger
+    # Route the root logger through a queue, replacing any handlers installed elsewhere
+    log_queue = queue.SimpleQueue()
     root_logger = logging.getLogger()
-    root_logger.addHandler(file_handler)
-    root_logger.addHandler(console_handler)
+    root_logger.setLevel(getattr(logging, settings.LOG_LEVEL.upper()))
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(UserContextFilter())
+    root_logger.handlers[:] = [queue_handler]
+
+    _listener = logging.handlers.QueueListener(
+        log_queue, file_handler, console_handler, respect_handler_level=True
+    )
+    _listener.start()
 
     # Configure specific loggers
     logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -51,5 +95,12 @@ def setup_logging():
     return logging.getLogger(__name__)
 
 
-# Initialize logging
-logger = setup_logging()
\ No newline at end of file
+@atexit.register
+def stop_logging():
+    """Flush queued records and stop the listener thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -1,48 +1,59 @@
 import asyncio
 import logging
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+import signal
+import sys
+from telegram.ext import Application, MessageHandler, CallbackQueryHandler, filters
+from telegram.request import HTTPXRequest
 import uvicorn
-from threading import Thread
-import traceback
 
 from .core.config import settings
+from .core.logging import setup_logging, stop_logging, user_id_var
 from .bot.handlers import bot_handlers
 from .backend.api import app as fastapi_app
 
-# Configure logging with more detailed format
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.DEBUG,  # Set to DEBUG for more detailed logs
-    handlers=[
-        logging.FileHandler(settings.LOG_FILE),
-        logging.StreamHandler()
-    ]
-)
+# Configure logging once for the whole process
+setup_logging()
 logger = logging.getLogger(__name__)
 
-# Also enable telegram library logging
-logging.getLogger("telegram").setLevel(logging.DEBUG)
-logging.getLogger("httpx").setLevel(logging.INFO)
+
+def install_uvloop():
+    """Use uvloop for the process event loop when available (installed with uvicorn[standard])"""
+    if sys.platform == "win32":
+        return
+    try:
+        import uvloop
+    except ImportError:
+        logger.info("uvloop not installed, using the default asyncio event loop")
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
 
 
 class TelegramAIBot:
     def __init__(self):
         self.telegram_app = None
-        self.fastapi_thread = None
-
-    def start_fastapi_server(self):
-        """Start FastAPI server in a separate thread"""
-        try:
-            logger.info(f"Starting FastAPI server on {settings.API_HOST}:{settings.API_PORT}")
-            uvicorn.run(
-                fastapi_app,
-                host=settings.API_HOST,
-                port=settings.API_PORT,
-                log_level=settings.LOG_LEVEL.lower()
-            )
-        except Exception as e:
-            logger.error(f"Failed to start FastAPI server: {e}")
-            logger.error(traceback.format_exc())
+        self.api_server = None
+        self.bot_username = None
+        self._stop = asyncio.Event()
+        self._commands = {
+            "start": self.wrapped_start_command,
+            "help": self.wrapped_help_command,
+            "clear": self.wrapped_clear_command,
+            "stats": self.wrapped_stats_command,
+        }
+
+    def create_api_server(self) -> uvicorn.Server:
+        """Build the FastAPI server to run on the bot's event loop"""
+        config = uvicorn.Config(
+            fastapi_app,
+            host=settings.API_HOST,
+            port=settings.API_PORT,
+            log_level=settings.LOG_LEVEL.lower(),
+            http="auto",  # httptools when installed
+            access_log=False
+        )
+        server = uvicorn.Server(config)
+        server.install_signal_handlers = lambda: None  # signals are handled in run_services
+        return server
 
     async def start_telegram_bot(self):
         """Start Telegram bot"""
@@ -56,32 +67,37 @@ class TelegramAIBot:
             if not settings.TELEGRAM_BOT_TOKEN.startswith(('bot', 'BOT')):
                 logger.warning("Bot token doesn't start with 'bot' - this might be incorrect")
 
-            logger.info(f"Using bot token: {settings.TELEGRAM_BOT_TOKEN[:10]}...")
+            logger.info("Using bot token: %s...", settings.TELEGRAM_BOT_TOKEN[:10])
 
             # Create application with more explicit configuration
             self.telegram_app = (
                 Application.builder()
                 .token(settings.TELEGRAM_BOT_TOKEN)
+                .request(HTTPXRequest(  # replies and edits from concurrent handlers
+                    connection_pool_size=256,
+                    read_timeout=30,
+                    write_timeout=10,
+                    connect_timeout=10,
+                    pool_timeout=1
+                ))
+                .get_updates_request(HTTPXRequest(  # the single long-poll connection
+                    read_timeout=10,
+                    write_timeout=10,
+                    connect_timeout=10,
+                    pool_timeout=5
+                ))
                 .concurrent_updates(True)  # Enable concurrent updates
                 .build()
             )
 
             # Test bot token by getting bot info
             bot_info = await self.telegram_app.bot.get_me()
-            logger.info(f"Bot info: @{bot_info.username} ({bot_info.first_name})")
-
-            # Add handlers with logging
-            logger.info("Adding command handlers...")
-            self.telegram_app.add_handler(CommandHandler("start", self.wrapped_start_command))
-            self.telegram_app.add_handler(CommandHandler("help", self.wrapped_help_command))
-            self.telegram_app.add_handler(CommandHandler("clear", self.wrapped_clear_command))
-            self.telegram_app.add_handler(CommandHandler("stats", self.wrapped_stats_command))
+            logger.info("Bot info: @%s (%s)", bot_info.username, bot_info.first_name)
 
-            # Add message handler for all text messages
+            # One handler for all text: commands are routed by dict lookup
             logger.info("Adding message handler...")
-            self.telegram_app.add_handler(
-                MessageHandler(filters.TEXT & ~filters.COMMAND, self.wrapped_handle_message)
-            )
+            self.bot_username = bot_info.username
+            self.telegram_app.add_handler(MessageHandler(filters.TEXT, self.dispatch_text))
 
             # Add callback query handler
             logger.info("Adding callback query handler...")
@@ -101,87 +117,96 @@ class TelegramAIBot:
                 allowed_updates=['message', 'callback_query'],
                 drop_pending_updates=True,  # Drop pending updates on startup
                 bootstrap_retries=3,
-                read_timeout=10,
-                write_timeout=10,
-                connect_timeout=10,
-                pool_timeout=5
+                poll_interval=0.0,
+                timeout=25  # long-poll window held open by Telegram
             )
 
             logger.info("Telegram bot started successfully! Waiting for messages...")
 
-            # Keep the bot running indefinitely
-            # This prevents the async function from ending and cancelling the polling
-            try:
-                # Wait indefinitely until interrupted
-                while True:
-                    await asyncio.sleep(1)
-            except asyncio.CancelledError:
-                logger.info("Bot polling cancelled")
-                raise
+            # Keep polling until a shutdown is requested
+            await self._stop.wait()
 
         except Exception as e:
-            logger.error(f"Failed to start Telegram bot: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Failed to start Telegram bot: %s", e)
             raise
 
+    async def dispatch_text(self, update, context):
+        """Route /commands through the command table, everything else to the message handler"""
+        text = update.message.text
+        if not text.startswith("/"):
+            await self.wrapped_handle_message(update, context)
+            return
+
+        command, _, mention = text.split(maxsplit=1)[0][1:].partition("@")
+        if mention and mention.lower() != (self.bot_username or "").lower():
+            return  # addressed to another bot in a group
+
+        handler = self._commands.get(command.lower())
+        if handler:
+            await handler(update, context)
+
     # Wrapped handlers with logging and error handling
     async def wrapped_start_command(self, update, context):
         """Wrapped start command with logging"""
         try:
-            logger.info(f"Start command from user {update.effective_user.id}")
+            user_id_var.set(update.effective_user.id)
+            logger.info("Start command")
             await bot_handlers.start_command(update, context)
         except Exception as e:
-            logger.error(f"Error in start command: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error in start command: %s", e)
             await self.send_error_message(update, "Error processing start command")
 
     async def wrapped_help_command(self, update, context):
         """Wrapped help command with logging"""
         try:
-            logger.info(f"Help command from user {update.effective_user.id}")
+            user_id_var.set(update.effective_user.id)
+            logger.info("Help command")
             await bot_handlers.help_command(update, context)
         except Exception as e:
-            logger.error(f"Error in help command: {e}")
+            logger.error("Error in help command: %s", e)
             await self.send_error_message(update, "Error processing help command")
 
     async def wrapped_clear_command(self, update, context):
         """Wrapped clear command with logging"""
         try:
-            logger.info(f"Clear command from user {update.effective_user.id}")
+            user_id_var.set(update.effective_user.id)
+            logger.info("Clear command")
             await bot_handlers.clear_command(update, context)
         except Exception as e:
-            logger.error(f"Error in clear command: {e}")
+            logger.error("Error in clear command: %s", e)
             await self.send_error_message(update, "Error processing clear command")
 
     async def wrapped_stats_command(self, update, context):
         """Wrapped stats command with logging"""
         try:
-            logger.info(f"Stats command from user {update.effective_user.id}")
+            user_id_var.set(update.effective_user.id)
+            logger.info("Stats command")
             await bot_handlers.stats_command(update, context)
         except Exception as e:
-            logger.error(f"Error in stats command: {e}")
+            logger.error("Error in stats command: %s", e)
             await self.send_error_message(update, "Error processing stats command")
 
     async def wrapped_handle_message(self, update, context):
         """Wrapped message handler with logging"""
         try:
-            user_id = update.effective_user.id
-            message = update.message.text[:50] + "..." if len(update.message.text) > 50 else update.message.text
-            logger.info(f"Message from user {user_id}: {message}")
+            user_id_var.set(update.effective_user.id)
+            if logger.isEnabledFor(logging.INFO):
+                text = update.message.text
+                logger.info("Message: %s", text[:50] + "..." if len(text) > 50 else text)
 
             await bot_handlers.handle_message(update, context)
         except Exception as e:
-            logger.error(f"Error handling message: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Error handling message: %s", e)
             await self.send_error_message(update, "Error processing your message")
 
     async def wrapped_button_callback(self, update, context):
         """Wrapped button callback with logging"""
         try:
-            logger.info(f"Button callback from user {update.effective_user.id}: {update.callback_query.data}")
+            user_id_var.set(update.effective_user.id)
+            logger.info("Button callback: %s", update.callback_query.data)
             await bot_handlers.button_callback(update, context)
         except Exception as e:
-            logger.error(f"Error in button callback: {e}")
+            logger.error("Error in button callback: %s", e)
             await self.send_error_message(update, "Error processing button click")
 
     async def send_error_message(self, update, message):
@@ -192,12 +217,11 @@ class TelegramAIBot:
             elif update.callback_query:
                 await update.callback_query.message.reply_text(f"❌ {message}. Please try again.")
         except Exception as e:
-            logger.error(f"Failed to send error message: {e}")
+            logger.error("Failed to send error message: %s", e)
 
     async def error_handler(self, update, context):
         """Enhanced error handler"""
-        logger.error(f"Update {update} caused error {context.error}")
-        logger.error(traceback.format_exc())
+        logger.error("Update %s caused error %s", update, context.error, exc_info=context.error)
 
         try:
             if update and update.effective_message:
@@ -205,11 +229,17 @@ class TelegramAIBot:
                     "❌ An unexpected error occurred. Please try again or contact support."
                 )
         except Exception as e:
-            logger.error(f"Failed to send error message to user: {e}")
+            logger.error("Failed to send error message to user: %s", e)
+
+    def request_stop(self):
+        """Signal handler: let the bot's polling wait return"""
+        logger.info("Received shutdown signal")
+        self._stop.set()
 
     async def shutdown(self):
         """Shutdown bot gracefully"""
         logger.info("Shutting down bot...")
+        self._stop.set()
 
         try:
             if bot_handlers.session:
@@ -220,52 +250,49 @@ class TelegramAIBot:
                 await self.telegram_app.stop()
                 await self.telegram_app.shutdown()
         except Exception as e:
-            logger.error(f"Error during shutdown: {e}")
+            logger.error("Error during shutdown: %s", e)
 
         logger.info("Bot shutdown complete")
 
-    def run(self):
-        """Run both FastAPI and Telegram bot"""
-        try:
-            # Start FastAPI server in background thread
-            logger.info("Starting FastAPI server in background...")
-            self.fastapi_thread = Thread(target=self.start_fastapi_server, daemon=True)
-            self.fastapi_thread.start()
+    async def run_services(self):
+        """Run the FastAPI server and Telegram bot concurrently on one event loop"""
+        self.api_server = self.create_api_server()
+        logger.info("Starting FastAPI server on %s:%s", settings.API_HOST, settings.API_PORT)
+        api_task = asyncio.create_task(self.api_server.serve())
+        bot_task = asyncio.create_task(self.start_telegram_bot())
 
-            # Give FastAPI time to start
-            import time
-            time.sleep(2)
-
-            logger.info("FastAPI server started, now starting Telegram bot...")
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.request_stop)
+            except NotImplementedError:  # Windows: KeyboardInterrupt still stops asyncio.run
+                pass
 
-            # Start Telegram bot in main thread
-            asyncio.run(self.start_telegram_bot())
+        try:
+            # Either service ending (bot stopped, or the server failed to bind/start) stops both
+            await asyncio.wait({api_task, bot_task}, return_when=asyncio.FIRST_COMPLETED)
+            if api_task.done() and not bot_task.done():
+                logger.error("FastAPI server stopped, shutting down the bot")
+        finally:
+            await self.shutdown()
+            self.api_server.should_exit = True
+            await asyncio.gather(api_task, bot_task)
 
+    def run(self):
+        """Run both FastAPI and Telegram bot"""
+        try:
+            install_uvloop()
+            asyncio.run(self.run_services())
         except KeyboardInterrupt:
             logger.info("Received shutdown signal")
         except Exception as e:
-            logger.error(f"Critical error in main loop: {e}")
-            logger.error(traceback.format_exc())
+            logger.exception("Critical error in main loop: %s", e)
         finally:
-            try:
-                asyncio.run(self.shutdown())
-            except Exception as e:
-                logger.error(f"Error during final shutdown: {e}")
+            stop_logging()
 
 
 def main():
-    """Main entry point with validation"""
-    # Validate critical settings
-    if not hasattr(settings, 'TELEGRAM_BOT_TOKEN') or not settings.TELEGRAM_BOT_TOKEN:
-        print("ERROR: TELEGRAM_BOT_TOKEN is not set in settings!")
-        return
-
-    if not hasattr(settings, 'OPENAI_API_KEY') or not settings.OPENAI_API_KEY:
-        print("WARNING: OPENAI_API_KEY is not set in settings!")
-
-    print(f"Starting bot with token: {settings.TELEGRAM_BOT_TOKEN[:10]}...")
-    print(f"OpenAI API Key set: {'Yes' if settings.OPENAI_API_KEY else 'No'}")
-
+    """Main entry point; required settings were validated when app.core.config loaded"""
     bot = TelegramAIBot()
     bot.run()
 
@@ -1,4 +1,5 @@
 import pytest
+import pytest_asyncio
 import asyncio
 from unittest.mock import patch
 import os
@@ -7,7 +8,7 @@ import os
 os.environ["TELEGRAM_BOT_TOKEN"] = "test_token"
 os.environ["OPENAI_API_KEY"] = "test_openai_key"
 os.environ["API_SECRET_KEY"] = "test_secret_key"
-os.environ["DATABASE_URL"] = "sqlite:///./test.db"
+os.environ["DATABASE_URL"] = "sqlite:///:memory:"
 
 @pytest.fixture(scope="session")
 def event_loop():
@@ -16,6 +17,16 @@ def event_loop():
     yield loop
     loop.close()
 
+@pytest_asyncio.fixture(scope="session", autouse=True)
+async def init_database(event_loop):
+    """Create the schema once; the app's lifespan does this outside of tests"""
+    from app.core.database import async_engine, init_db
+
+    await init_db()
+    yield
+    # Close the shared in-memory connection so its worker thread doesn't block exit
+    await async_engine.dispose()
+
 @pytest.fixture(autouse=True)
 def setup_test_environment():
     """Setup test environment"""
@@ -23,7 +34,7 @@ def setup_test_environment():
         mock_settings.TELEGRAM_BOT_TOKEN = "test_token"
         mock_settings.OPENAI_API_KEY = "test_openai_key"
         mock_settings.API_SECRET_KEY = "test_secret_key"
-        mock_settings.DATABASE_URL = "sqlite:///./test.db"
+        mock_settings.DATABASE_URL = "sqlite:///:memory:"
         mock_settings.WHITELISTED_USERS = []
         mock_settings.ADMIN_USER_IDS = [123456789]
         mock_settings.RATE_LIMIT_MESSAGES = 100
@@ -1,19 +1,27 @@
 import pytest
+import pytest_asyncio
 import asyncio
-from unittest.mock import AsyncMock, patch, MagicMock
-from fastapi.testclient import TestClient
+import httpx
+from types import SimpleNamespace
+from unittest.mock import DEFAULT, AsyncMock, patch
+from fastapi import BackgroundTasks
 
-from app.backend.api import app
 from app.backend.ai_agent import AIAgent
-from app.backend.models import ChatRequest, ChatResponse
+from app.backend.models import STREAM_ERROR_SENTINEL, ChatRequest, ChatResponse
 from app.core.config import settings
 
-client = TestClient(app)
+AUTH = {"Authorization": f"Bearer {settings.API_SECRET_KEY}"}
 
 
-@pytest.fixture
-def auth_headers():
-    return {"Authorization": f"Bearer {settings.API_SECRET_KEY}"}
+@pytest_asyncio.fixture(scope="session")
+async def client():
+    # Imported here so runs that select no API tests don't build the FastAPI app
+    from app.backend.api import app
+
+    # Requests run on the test event loop, without TestClient's portal thread; the schema
+    # comes from conftest's init_database, so the app's lifespan isn't needed
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as c:
+        yield c
 
 
 @pytest.fixture
@@ -21,25 +29,31 @@ def ai_agent():
     return AIAgent()
 
 
-def test_health_endpoint():
+@pytest.fixture
+def agent_calls(ai_agent):
+    """Stub the agent's LLM call and persistence; tests reconfigure the mocks as needed"""
+    with patch.multiple(ai_agent, _generate_response=DEFAULT, _persist_turn=DEFAULT) as mocks:
+        mocks['_generate_response'].return_value = ("Test response", 42)
+        yield SimpleNamespace(generate=mocks['_generate_response'], persist=mocks['_persist_turn'])
+
+
+@pytest.mark.asyncio
+async def test_health_endpoint(client):
     """Test health check endpoint"""
-    response = client.get("/health")
+    response = await client.get("/health")
     assert response.status_code == 200
     data = response.json()
     assert data["status"] == "healthy"
 
 
-def test_chat_endpoint_unauthorized():
-    """Test chat endpoint without authorization"""
-    response = client.post("/chat", json={
-        "user_id": 123456789,
-        "message": "Hello"
-    })
-    assert response.status_code == 403
-
-
-def test_chat_endpoint_authorized(auth_headers):
-    """Test chat endpoint with authorization"""
+@pytest.mark.parametrize("headers,status", [
+    (AUTH, 200),
+    ({}, 403),
+    ({"Authorization": "Bearer invalid-key"}, 401),
+], ids=["valid", "missing", "invalid"])
+@pytest.mark.asyncio
+async def test_chat_endpoint_auth(client, headers, status):
+    """Test chat endpoint authorization"""
     with patch('app.backend.ai_agent.ai_agent.process_message') as mock_process:
         mock_process.return_value = ChatResponse(
             response="Hello! How can I help you?",
@@ -47,49 +61,191 @@ def test_chat_endpoint_authorized(auth_headers):
             success=True
         )
 
-        response = client.post("/chat", json={
+        response = await client.post("/chat", json={
             "user_id": 123456789,
             "message": "Hello"
-        }, headers=auth_headers)
+        }, headers=headers)
 
-        assert response.status_code == 200
+    assert response.status_code == status
+    if status == 200:
         data = response.json()
         assert data["success"] is True
         assert "Hello! How can I help you?" in data["response"]
+    else:
+        mock_process.assert_not_called()
 
 
 @pytest.mark.asyncio
-async def test_ai_agent_process_message(ai_agent):
+async def test_ai_agent_process_message(ai_agent, agent_calls):
     """Test AI agent message processing"""
-    with patch.object(ai_agent, '_generate_response', new=AsyncMock(return_value="Test response")):
-        with patch.object(ai_agent, '_get_session_context', new=AsyncMock(return_value=[])):
-            with patch.object(ai_agent, '_update_session_context', new=AsyncMock()):
-                with patch.object(ai_agent, '_log_conversation', new=AsyncMock()):
-                    response = await ai_agent.process_message(
-                        user_id=123456789,
-                        message="Hello",
-                        session_id="test_session"
-                    )
-
-                    assert response.success is True
-                    assert response.response == "Test response"
-                    assert response.session_id == "test_session"
-
-
-def test_create_user_endpoint(auth_headers):
-    """Test user creation endpoint"""
-    with patch('app.core.database.get_db') as mock_get_db:
-        mock_db = MagicMock()
-        mock_get_db.return_value.__next__.return_value = mock_db
-        mock_db.query.return_value.filter.return_value.first.return_value = None
-
-        response = client.post("/users", json={
-            "telegram_user_id": 123456789,
-            "username": "testuser",
-            "first_name": "Test",
-            "last_name": "User"
-        }, headers=auth_headers)
-
-        assert response.status_code == 200
-        data = response.json()
-        assert data["status"] == "success"
\ No newline at end of file
+    with patch.object(ai_agent, '_get_session_context', new=AsyncMock(return_value=[])):
+        response = await ai_agent.process_message(
+            user_id=123456789,
+            message="Hello",
+            session_id="test_session"
+        )
+
+    assert response.success is True
+    assert response.response == "Test response"
+    assert response.session_id == "test_session"
+    agent_calls.persist.assert_awaited_once()
+    assert agent_calls.persist.await_args.args[-1] == 42  # tokens_used
+
+
+@pytest.mark.asyncio
+async def test_ai_agent_defers_persistence_to_background(ai_agent, agent_calls):
+    """Test turn persistence is scheduled as a background task"""
+    background_tasks = BackgroundTasks()
+    response = await ai_agent.process_message(
+        user_id=123456789,
+        message="Hello",
+        session_id="test_session",
+        background_tasks=background_tasks
+    )
+
+    assert response.success is True
+    agent_calls.persist.assert_not_awaited()
+    assert len(background_tasks.tasks) == 1
+
+    await background_tasks()
+    agent_calls.persist.assert_awaited_once()
+
+
+@pytest.mark.asyncio
+async def test_create_user_endpoint(client):
+    """Test user creation endpoint against the in-memory test database"""
+    response = await client.post("/users", json={
+        "telegram_user_id": 123456789,
+        "username": "testuser",
+        "first_name": "Test",
+        "last_name": "User"
+    }, headers=AUTH)
+
+    assert response.status_code == 200
+    data = response.json()
+    assert data["status"] == "success"
+
+
+@pytest.mark.asyncio
+async def test_ai_agent_stream_message_raises_on_failure(ai_agent, agent_calls):
+    """Test streaming failures propagate instead of being sent as response text"""
+    async def failing_stream(context, usage):
+        yield "Hel"
+        raise RuntimeError("upstream closed")
+
+    with patch.object(ai_agent, '_get_session_context', new=AsyncMock(return_value=[])), \
+            patch.object(ai_agent, '_stream_response', new=failing_stream):
+        chunks = []
+        with pytest.raises(RuntimeError):
+            async for chunk in ai_agent.stream_message(user_id=123456789, message="Hello", session_id="s"):
+                chunks.append(chunk)
+
+    assert chunks == ["Hel"]
+    agent_calls.persist.assert_not_awaited()
+
+
+@pytest.mark.parametrize("fail_after,status,body", [
+    (None, 200, "Hello world"),
+    (0, 500, None),
+    (1, 200, "Hello " + STREAM_ERROR_SENTINEL),
+], ids=["complete", "fails-before-first-chunk", "fails-mid-stream"])
+@pytest.mark.asyncio
+async def test_chat_stream_endpoint_reports_failures_out_of_band(client, fail_after, status, body):
+    """Test /chat/stream fails with a 500 before the first chunk and with the sentinel after it"""
+    async def stream(**kwargs):
+        for i, chunk in enumerate(("Hello ", "world")):
+            if i == fail_after:
+                raise RuntimeError("upstream closed")
+            yield chunk
+
+    with patch('app.backend.ai_agent.ai_agent.stream_message', new=stream):
+        response = await client.post("/chat/stream", json={
+            "user_id": 123456789,
+            "message": "Hello"
+        }, headers=AUTH)
+
+    assert response.status_code == status
+    if body is not None:
+        assert response.text == body
+
+
+@pytest.mark.asyncio
+async def test_semantic_cache_hit_and_miss():
+    """Test semantic cache returns responses only for similar messages"""
+    np = pytest.importorskip("numpy")
+    from app.backend.semantic_cache import SemanticCache
+
+    vectors = {
+        "What is Python?": np.array([1.0, 0.0]),
+        "what is python": np.array([0.99, 0.141]),
+        "Tell me a joke": np.array([0.0, 1.0]),
+    }
+    cache = SemanticCache(embed=vectors.__getitem__, threshold=0.92, max_entries=10)
+    context = [{"role": "system", "content": "test"}]
+
+    await cache.store("What is Python?", context, "A programming language.")
+
+    assert await cache.lookup("what is python", context) == "A programming language."
+    assert await cache.lookup("Tell me a joke", context) is None
+    assert await cache.lookup("what is python", context + [{"role": "user", "content": "hi"}]) is None
+
+
+@pytest.mark.asyncio
+async def test_request_batcher_bounds_concurrency():
+    """Test batcher fans out requests without exceeding the concurrency limit"""
+    from app.backend.batcher import RequestBatcher
+
+    in_flight = 0
+    peak = 0
+
+    async def handler(messages):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return messages[-1]["content"].upper()
+
+    batcher = RequestBatcher(handler, max_batch_size=8, batch_timeout=0.005, max_concurrency=2)
+    results = await asyncio.gather(*(
+        batcher.submit([{"role": "user", "content": f"msg {i}"}]) for i in range(5)
+    ))
+
+    assert results == [f"MSG {i}" for i in range(5)]
+    assert peak == 2
+
+    worker = batcher._worker
+    await batcher.aclose()
+    assert worker.cancelled()
+
+
+@pytest.mark.asyncio
+async def test_token_bucket_waits_when_budget_exhausted():
+    """Test token bucket delays requests beyond the per-minute budget"""
+    from app.backend.token_bucket import AsyncTokenBucket
+
+    bucket = AsyncTokenBucket(tokens_per_minute=6000, requests_per_minute=6000)
+    await bucket.acquire(6000)
+
+    start = asyncio.get_running_loop().time()
+    await bucket.acquire(10)  # refills at 100 tokens/s
+    assert asyncio.get_running_loop().time() - start >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_persist_turn_without_native_upsert(ai_agent):
+    """Test dialects without ON CONFLICT fall back to update-or-insert"""
+    from sqlalchemy import select
+    from app.backend import ai_agent as agent_module
+    from app.core.database import AsyncSessionLocal, UserSession
+
+    with patch.dict(agent_module.UPSERT_INSERTS, clear=True):
+        for content in ("first", "second"):
+            context = [{"role": "user", "content": content}]
+            await ai_agent._persist_turn(123456789, "fallback_session", context, content, "ok", 1, 0)
+
+    async with AsyncSessionLocal() as db:
+        contexts = (await db.execute(
+            select(UserSession.context).where(UserSession.session_id == "fallback_session")
+        )).scalars().all()
+    assert [agent_module.unpack_context(c) for c in contexts] == [[{"role": "user", "content": "second"}]]
@@ -1,57 +1,74 @@
 import pytest
 import asyncio
-from unittest.mock import AsyncMock, MagicMock, patch
-from telegram import Update, User, Message, Chat
-from telegram.ext import ContextTypes
+from types import SimpleNamespace
+from unittest.mock import DEFAULT, AsyncMock, patch
 
 from app.bot.handlers import BotHandlers
 from app.core.config import settings
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def bot_handlers():
     return BotHandlers()
 
 
+@pytest.fixture(autouse=True)
+def reset_bot_handlers(bot_handlers):
+    bot_handlers.user_sessions.clear()
+    bot_handlers._background_tasks.clear()
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limits():
+    from app.bot import middleware
+
+    middleware.user_message_windows.clear()
+
+
 @pytest.fixture
 def mock_update():
-    update = MagicMock(spec=Update)
-    update.effective_user = MagicMock(spec=User)
-    update.effective_user.id = 123456789
-    update.effective_user.first_name = "Test"
-    update.effective_user.username = "testuser"
-    update.message = MagicMock(spec=Message)
-    update.message.text = "Hello, bot!"
-    update.effective_chat = MagicMock(spec=Chat)
-    update.effective_chat.id = 123456789
-    return update
+    # Plain namespaces: handlers only read these attributes, and spec'd mocks are slow to build
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=123456789, first_name="Test", username="testuser"),
+        message=SimpleNamespace(text="Hello, bot!", reply_text=AsyncMock()),
+        effective_chat=SimpleNamespace(id=123456789)
+    )
+
+
+@pytest.fixture
+def backend(bot_handlers):
+    """Replace the handlers' backend calls with AsyncMocks for the duration of a test"""
+    # DEFAULT patches async methods with AsyncMocks
+    with patch.multiple(bot_handlers, _update_user_info=DEFAULT, _prewarm_session=DEFAULT,
+                        _clear_session=DEFAULT) as mocks:
+        yield SimpleNamespace(
+            update_user_info=mocks['_update_user_info'],
+            prewarm_session=mocks['_prewarm_session'],
+            clear_session=mocks['_clear_session']
+        )
 
 
 @pytest.fixture
 def mock_context():
-    context = MagicMock(spec=ContextTypes.DEFAULT_TYPE)
-    context.bot = AsyncMock()
-    return context
+    return SimpleNamespace(bot=SimpleNamespace(send_chat_action=AsyncMock()))
 
 
 @pytest.mark.asyncio
-async def test_start_command(bot_handlers, mock_update, mock_context):
+async def test_start_command(bot_handlers, backend, mock_update, mock_context):
     """Test /start command handler"""
-    with patch.object(bot_handlers, '_update_user_info', new=AsyncMock()):
-        mock_update.message.reply_text = AsyncMock()
+    await bot_handlers.start_command(mock_update, mock_context)
+    await asyncio.gather(*bot_handlers._background_tasks)
 
-        await bot_handlers.start_command(mock_update, mock_context)
+    backend.prewarm_session.assert_awaited_once_with(mock_update.effective_user.id)
 
-        mock_update.message.reply_text.assert_called_once()
-        call_args = mock_update.message.reply_text.call_args
-        assert "Welcome to AI Assistant Bot" in call_args[0][0]
+    mock_update.message.reply_text.assert_called_once()
+    call_args = mock_update.message.reply_text.call_args
+    assert "Welcome to AI Assistant Bot" in call_args[0][0]
 
 
 @pytest.mark.asyncio
 async def test_help_command(bot_handlers, mock_update, mock_context):
     """Test /help command handler"""
-    mock_update.message.reply_text = AsyncMock()
-
     await bot_handlers.help_command(mock_update, mock_context)
 
     mock_update.message.reply_text.assert_called_once()
@@ -61,36 +78,91 @@ async def test_help_command(bot_handlers, mock_update, mock_context):
 
 @pytest.mark.asyncio
 async def test_handle_message(bot_handlers, mock_update, mock_context):
-    """Test message handling"""
-    mock_response = {
-        "success": True,
-        "response": "Hello! How can I help you today?"
-    }
+    """Test message handling streams the response into one reply"""
+    async def mock_stream(user_id, message, session_id):
+        for chunk in ("Hello! How can I ", "help you today?"):
+            yield chunk
 
-    with patch.object(bot_handlers, '_send_to_ai_backend', new=AsyncMock(return_value=mock_response)):
-        mock_update.message.reply_text = AsyncMock()
-        mock_context.bot.send_chat_action = AsyncMock()
+    with patch.object(bot_handlers, '_stream_from_ai_backend', new=mock_stream):
+        mock_update.message.reply_text.return_value = AsyncMock()
 
         await bot_handlers.handle_message(mock_update, mock_context)
 
         mock_context.bot.send_chat_action.assert_called_once()
-        mock_update.message.reply_text.assert_called_once_with(mock_response["response"])
+        mock_update.message.reply_text.assert_called_once_with("Hello! How can I ")
+        reply = mock_update.message.reply_text.return_value
+        reply.edit_text.assert_awaited_once_with("Hello! How can I help you today?")
 
 
 @pytest.mark.asyncio
-async def test_clear_command(bot_handlers, mock_update, mock_context):
+async def test_clear_command(bot_handlers, backend, mock_update, mock_context):
     """Test /clear command handler"""
     user_id = mock_update.effective_user.id
     bot_handlers.user_sessions[user_id] = "test_session_123"
 
-    with patch.object(bot_handlers, '_clear_session', new=AsyncMock()):
-        mock_update.message.reply_text = AsyncMock()
+    await bot_handlers.clear_command(mock_update, mock_context)
+
+    backend.clear_session.assert_awaited_once()
+    mock_update.message.reply_text.assert_called_once()
+    call_args = mock_update.message.reply_text.call_args
+    assert "Conversation cleared" in call_args[0][0]
+
+    # Check that new session ID was generated
+    assert bot_handlers.user_sessions[user_id] != "test_session_123"
 
-        await bot_handlers.clear_command(mock_update, mock_context)
 
-        mock_update.message.reply_text.assert_called_once()
-        call_args = mock_update.message.reply_text.call_args
-        assert "Conversation cleared" in call_args[0][0]
+def test_split_message_prefers_paragraph_boundaries():
+    """Test long responses are split on paragraph boundaries within the limit"""
+    from app.bot.utils import split_message
 
-        # Check that new session ID was generated
-        assert bot_handlers.user_sessions[user_id] != "test_session_123"
\ No newline at end of file
+    text = "a" * 3000 + "\n\n" + "b" * 3000
+    assert list(split_message(text)) == ["a" * 3000, "b" * 3000]
+    assert list(split_message("short")) == ["short"]
+    assert [len(chunk) for chunk in split_message("c" * 5000)] == [4096, 904]
+
+
+@pytest.mark.asyncio
+async def test_rate_limiter_blocks_after_limit(mock_update, mock_context):
+    """Test protected handlers reject messages beyond the per-window limit"""
+    from app.bot import middleware
+
+    handler = AsyncMock()
+    limited = middleware.protected(handler)
+
+    for _ in range(settings.RATE_LIMIT_MESSAGES + 1):
+        await limited(mock_update, mock_context)
+
+    assert handler.await_count == settings.RATE_LIMIT_MESSAGES
+    mock_update.message.reply_text.assert_called_once()
+
+
+@pytest.mark.asyncio
+async def test_access_control_silently_drops_unauthorized(bot_handlers, mock_update, mock_context):
+    """Test non-whitelisted users are rejected before rate limiting, without a reply"""
+    from app.bot import middleware
+
+    with patch.object(settings, 'WHITELISTED_USERS', frozenset({1})), \
+            patch.object(settings, 'SILENT_REJECT_UNAUTHORIZED', True):
+        await bot_handlers.help_command(mock_update, mock_context)
+
+    mock_update.message.reply_text.assert_not_called()
+    assert mock_update.effective_user.id not in middleware.user_message_windows
+
+
+@pytest.mark.asyncio
+async def test_user_stats_sum_persisted_tokens(bot_handlers):
+    """Test /stats totals the tokens recorded with each persisted turn"""
+    from app.backend.ai_agent import ai_agent
+    from app.core.database import AsyncSessionLocal, User
+
+    user_id = 555000111
+    async with AsyncSessionLocal() as db:
+        db.add(User(telegram_user_id=user_id))
+        await db.commit()
+    for tokens_used in (7, 5):
+        await ai_agent._persist_turn(user_id, "stats_session", [], "Hi", "Hello", 10, tokens_used)
+
+    stats = await bot_handlers._get_user_stats(user_id)
+
+    assert stats["total_messages"] == 2
+    assert stats["total_tokens"] == 12